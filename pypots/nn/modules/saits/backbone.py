@@ -61,13 +61,15 @@ class BackboneSAITS(nn.Module):
         )
         self.reduce_dim_z = nn.Linear(d_model, n_features)
 
-        # for the 2nd block
+        # for the 2nd block, the positional-encoding module of the 1st block is shared,
+        # hence a single table is kept, which stays shared after moving the model with .to(device)
         self.embedding_2 = SaitsEmbedding(
             actual_n_features,
             d_model,
             with_pos=True,
             n_max_steps=n_steps,
             dropout=dropout,
+            position_enc=self.embedding_1.position_enc,
         )
         self.layer_stack_for_second_block = nn.ModuleList(
             [
@@ -100,7 +102,9 @@ class BackboneSAITS(nn.Module):
         )  # namely, term e in the math equation
         first_DMSA_attn_weights = None
         for encoder_layer in self.layer_stack_for_first_block:
-            enc_output, first_DMSA_attn_weights = encoder_layer(enc_output, attn_mask)
+            enc_output, first_DMSA_attn_weights = encoder_layer(
+                enc_output, attn_mask, return_attn_weights=True
+            )
         X_tilde_1 = self.reduce_dim_z(enc_output)
         X_prime = missing_mask * X + (1 - missing_mask) * X_tilde_1
 
@@ -110,7 +114,9 @@ class BackboneSAITS(nn.Module):
         )  # namely term alpha in math algo
         second_DMSA_attn_weights = None
         for encoder_layer in self.layer_stack_for_second_block:
-            enc_output, second_DMSA_attn_weights = encoder_layer(enc_output, attn_mask)
+            enc_output, second_DMSA_attn_weights = encoder_layer(
+                enc_output, attn_mask, return_attn_weights=True
+            )
         X_tilde_2 = self.reduce_dim_gamma(F.relu(self.reduce_dim_beta(enc_output)))
 
         # attention-weighted combine
@@ -5,6 +5,8 @@
 # Created by Wenjie Du <wenjay.du@gmail.com>
 # License: BSD-3-Clause
 
+from typing import Optional
+
 import torch
 import torch.nn as nn
 
@@ -32,6 +34,11 @@ class SaitsEmbedding(nn.Module):
     dropout :
         The dropout rate.
 
+    position_enc :
+        An existing positional-encoding module to share, e.g. the one of another embedding block with the same
+        ``d_out`` and ``n_max_steps``, so that the two blocks hold a single positional table.
+        It only works when ``with_pos`` is True. If not given, a new one is created.
+
     """
 
     def __init__(
@@ -41,15 +48,19 @@ class SaitsEmbedding(nn.Module):
         with_pos: bool,
         n_max_steps: int = 1000,
         dropout: float = 0,
+        position_enc: Optional[PositionalEncoding] = None,
     ):
         super().__init__()
         self.with_pos = with_pos
         self.dropout_rate = dropout
 
         self.embedding_layer = nn.Linear(d_in, d_out)
-        self.position_enc = (
-            PositionalEncoding(d_out, n_positions=n_max_steps) if with_pos else None
-        )
+        if not with_pos:
+            self.position_enc = None
+        elif position_enc is not None:
+            self.position_enc = position_enc
+        else:
+            self.position_enc = PositionalEncoding(d_out, n_positions=n_max_steps)
         self.dropout = nn.Dropout(p=dropout) if dropout > 0 else None
 
     def forward(self, X, missing_mask=None):
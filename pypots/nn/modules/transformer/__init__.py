@@ -18,6 +18,10 @@ Notes
 -----
 This implementation is inspired by https://github.com/WenjieDu/SAITS
 
+The modules support mixed-precision training and inference with
+``torch.autocast(device_type="cuda", dtype=torch.bfloat16)``, under which the linear projections and the attention
+run in bfloat16 while layer-norm and softmax are computed in float32 by autocast itself.
+
 """
 
 # Created by Wenjie Du <wenjay.du@gmail.com>
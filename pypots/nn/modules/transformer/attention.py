@@ -18,6 +18,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from abc import abstractmethod
 
+# F.scaled_dot_product_attention (with the argument `scale`) is available since torch v2.1,
+# it dispatches to the fused FlashAttention/memory-efficient kernels if possible
+SDPA_AVAILABLE = tuple(int(i) for i in torch.__version__.split(".")[:2]) >= (2, 1)
+
 
 class AttentionOperator(nn.Module):
     """
@@ -50,6 +54,11 @@ class ScaledDotProductAttention(AttentionOperator):
     attn_dropout:
         The dropout rate for the attention map.
 
+    Notes
+    -----
+    If the attention map is not required, i.e. return_attn_weights is False, the computation will be dispatched to
+    torch.nn.functional.scaled_dot_product_attention (torch>=2.1) to avoid materializing the attention map.
+
     """
 
     def __init__(self, temperature: float, attn_dropout: float = 0.1):
@@ -57,7 +66,10 @@ class ScaledDotProductAttention(AttentionOperator):
         assert temperature > 0, "temperature should be positive"
         assert attn_dropout >= 0, "dropout rate should be non-negative"
         self.temperature = temperature
-        self.dropout = nn.Dropout(attn_dropout) if attn_dropout > 0 else None
+        # precompute the scaling factor to multiply with rather than dividing by the temperature in every call
+        self.scale = 1 / temperature
+        # only keep the dropout rate, which is applied inside the fused kernel or with F.dropout
+        self.attn_dropout = attn_dropout
 
     def forward(
         self,
@@ -65,8 +77,9 @@ class ScaledDotProductAttention(AttentionOperator):
         k: torch.Tensor,
         v: torch.Tensor,
         attn_mask: Optional[torch.Tensor] = None,
+        return_attn_weights: bool = False,
         **kwargs,
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         """Forward processing of the scaled dot-product attention.
 
         Parameters
@@ -84,32 +97,87 @@ class ScaledDotProductAttention(AttentionOperator):
             Masking tensor for the attention map. The shape should be [batch_size, n_heads, n_steps, n_steps].
             0 in attn_mask means values at the according position in the attention map will be masked out.
 
+        return_attn_weights:
+            Whether to compute and return the attention map.
+
         Returns
         -------
         output:
             The result of Value multiplied with the scaled dot-product attention map.
 
         attn:
-            The scaled dot-product attention map.
+            The scaled dot-product attention map. None if return_attn_weights is False.
 
         """
         # q, k, v all have 4 dimensions [batch_size, n_steps, n_heads, d_tensor]
         # d_tensor could be d_q, d_k, d_v
 
         # transpose for attention dot product: [batch_size, n_heads, n_steps, d_k or d_v]
+        # these are views without copying, their last dimension stays contiguous as the fused kernels require,
+        # so don't call .contiguous() on them here
         q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
 
-        # dot product q with k.T to obtain similarity
-        attn = torch.matmul(q / self.temperature, k.transpose(2, 3))
-
-        # apply masking on the attention map, this is optional
+        # turn the mask into an additive bias, masks prepared by TransformerEncoder/TransformerDecoder are boolean.
+        # the min value of the dtype rather than -1e9 is used to stay finite in half precision.
+        # it's passed to SDPA as well rather than the boolean mask, with which SDPA gives zeros or NaN for the
+        # fully masked rows, so both paths give the uniform attention over all positions in this case as before
+        attn_bias = None
         if attn_mask is not None:
-            attn = attn.masked_fill(attn_mask == 0, -1e9)
-
-        # compute attention score [0, 1], then apply dropout
-        attn = F.softmax(attn, dim=-1)
-        if self.dropout is not None:
-            attn = self.dropout(attn)
+            if attn_mask.dtype != torch.bool:
+                attn_mask = attn_mask != 0
+            attn_bias = torch.zeros_like(attn_mask, dtype=q.dtype)
+            attn_bias.masked_fill_(~attn_mask, torch.finfo(q.dtype).min)
+
+        if not return_attn_weights and SDPA_AVAILABLE:
+            output = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=attn_bias,
+                dropout_p=self.attn_dropout if self.training else 0.0,
+                scale=self.scale,
+            )
+            return output, None
+
+        # flatten the batch and head axes for the batched GEMM
+        batch_size, n_heads, q_len, d_k = q.shape
+        k_len = k.size(2)
+        q_flat = q.reshape(batch_size * n_heads, q_len, d_k)
+        k_flat = k.reshape(batch_size * n_heads, k_len, d_k)
+
+        # dot product q with k.T to obtain similarity, scaling is fused into the GEMM with alpha.
+        # masking on the attention map is optional, if applied, the additive bias is added to the attention map.
+        # a bias shared by all samples and heads is broadcast on the flattened batch axis without copying and fused
+        # into the GEMM with beta, others are added in place after the GEMM, which broadcasts them on the head
+        # axis rather than materializing an expanded copy of shape [batch_size*n_heads, q_len, k_len]
+        shared_bias = (
+            attn_bias is not None and attn_bias.size(0) == 1 and attn_bias.size(1) == 1
+        )
+        if shared_bias:
+            attn = torch.baddbmm(
+                attn_bias.expand(1, 1, q_len, k_len).reshape(1, q_len, k_len),
+                q_flat,
+                k_flat.transpose(1, 2),
+                alpha=self.scale,
+            )
+        else:
+            # with beta=0, the input tensor is ignored
+            attn = torch.baddbmm(
+                q_flat.new_empty(1, 1, 1),
+                q_flat,
+                k_flat.transpose(1, 2),
+                beta=0,
+                alpha=self.scale,
+            )
+        attn = attn.view(batch_size, n_heads, q_len, k_len)
+        if attn_bias is not None and not shared_bias:
+            attn.add_(attn_bias)
+
+        # compute attention score [0, 1], then apply dropout.
+        # softmax always reduces in float32 for accuracy, then casts back to the dtype of v (no-op in float32)
+        attn = torch.softmax(attn, dim=-1, dtype=torch.float32).to(v.dtype)
+        if self.attn_dropout > 0:
+            attn = F.dropout(attn, p=self.attn_dropout, training=self.training)
 
         # multiply the score with v
         output = torch.matmul(attn, v)
@@ -152,13 +220,44 @@ class MultiHeadAttention(nn.Module):
         self.d_k = d_k
         self.d_v = d_v
 
-        self.w_qs = nn.Linear(d_model, n_heads * d_k, bias=False)
-        self.w_ks = nn.Linear(d_model, n_heads * d_k, bias=False)
-        self.w_vs = nn.Linear(d_model, n_heads * d_v, bias=False)
+        # the projections of q, k, v are fused into one linear layer,
+        # hence self-attention only needs a single GEMM to obtain q, k, v
+        self.qkv_split_sizes = [n_heads * d_k, n_heads * d_k, n_heads * d_v]
+        self.w_qkv = nn.Linear(d_model, sum(self.qkv_split_sizes), bias=False)
 
         self.attention_operator = attn_opt
         self.fc = nn.Linear(n_heads * d_v, d_model, bias=False)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # be compatible with the checkpoints saved before fusing the projections of q, k, v
+        separate_keys = [f"{prefix}w_{i}s.weight" for i in ("q", "k", "v")]
+        if all(key in state_dict for key in separate_keys):
+            state_dict[f"{prefix}w_qkv.weight"] = torch.cat(
+                [state_dict.pop(key) for key in separate_keys]
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _project_qkv(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if q is k and k is v:
+            # self-attention, project q, k, v all at once
+            return self.w_qkv(q).split(self.qkv_split_sizes, dim=-1)
+
+        q_size = self.qkv_split_sizes[0]
+        w_q, w_kv = self.w_qkv.weight[:q_size], self.w_qkv.weight[q_size:]
+        q = F.linear(q, w_q)
+        if k is v:
+            # cross-attention with the same key and value, project k and v at once
+            k, v = F.linear(k, w_kv).split(self.qkv_split_sizes[1:], dim=-1)
+        else:
+            w_k, w_v = w_kv.split(self.qkv_split_sizes[1:])
+            k, v = F.linear(k, w_k), F.linear(v, w_v)
+        return q, k, v
+
     def forward(
         self,
         q: torch.Tensor,
@@ -200,20 +299,23 @@ class MultiHeadAttention(nn.Module):
         v_len = v.size(1)
 
         # now separate the last dimension of q, k, v into different heads -> [batch_size, n_steps, n_heads, d_k or d_v]
-        q = self.w_qs(q).view(batch_size, q_len, self.n_heads, self.d_k)
-        k = self.w_ks(k).view(batch_size, k_len, self.n_heads, self.d_k)
-        v = self.w_vs(v).view(batch_size, v_len, self.n_heads, self.d_v)
+        q, k, v = self._project_qkv(q, k, v)
+        q = q.view(batch_size, q_len, self.n_heads, self.d_k)
+        k = k.view(batch_size, k_len, self.n_heads, self.d_k)
+        v = v.view(batch_size, v_len, self.n_heads, self.d_v)
         # for generalization, we don't do transposing here but leave it for the attention operator if necessary
 
-        if attn_mask is not None:
-            # broadcasting on the head axis
+        if attn_mask is not None and attn_mask.dim() == 3:
+            # broadcasting on the head axis, skipped if the caller has already expanded the mask
             attn_mask = attn_mask.unsqueeze(1)
 
         v, attn_weights = self.attention_operator(q, k, v, attn_mask, **kwargs)
 
         # transpose back -> [batch_size, n_steps, n_heads, d_v]
-        # then merge the last two dimensions to combine all the heads -> [batch_size, n_steps, n_heads*d_v]
-        v = v.transpose(1, 2).contiguous().view(batch_size, q_len, -1)
+        # then merge the last two dimensions to combine all the heads -> [batch_size, n_steps, n_heads*d_v],
+        # reshape only copies if needed, e.g. the output of the fused attention kernels may already be
+        # a transposed view of a [batch_size, n_steps, n_heads, d_v] buffer, then merging heads is free
+        v = v.transpose(1, 2).reshape(batch_size, q_len, -1)
         v = self.fc(v)
 
         return v, attn_weights
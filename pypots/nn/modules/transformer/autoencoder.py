@@ -15,6 +15,19 @@ from .embedding import PositionalEncoding
 from .layers import TransformerEncoderLayer, TransformerDecoderLayer
 
 
+def _prepare_attn_mask(attn_mask: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    """Turn the attention mask into a boolean one broadcastable on the head axis,
+    which is done only once in the encoder/decoder rather than in every layer.
+    """
+    if attn_mask is None:
+        return None
+    if attn_mask.dtype != torch.bool:
+        attn_mask = attn_mask != 0
+    if attn_mask.dim() == 3:
+        attn_mask = attn_mask.unsqueeze(1)
+    return attn_mask
+
+
 class TransformerEncoder(nn.Module):
     """Transformer encoder.
 
@@ -45,6 +58,18 @@ class TransformerEncoder(nn.Module):
     attn_dropout:
         The dropout rate for the attention map.
 
+    norm_first:
+        Whether to apply layer-norm before each sub-layer (Pre-LN) rather than after the residual connection
+        (Post-LN). Models trained with the previous versions of PyPOTS are Post-LN and require norm_first=False.
+        With Pre-LN, a final layer-norm is applied to the output of the last layer.
+
+    activation:
+        The activation function of the feed-forward networks, "relu" or "gelu".
+
+    compile_layers:
+        Whether to compile each encoder layer with torch.compile (torch>=2.2) to fuse its operations into
+        fewer kernels. The compilation happens lazily in the first forward pass.
+
     """
 
     def __init__(
@@ -57,6 +82,9 @@ class TransformerEncoder(nn.Module):
         d_ffn: int,
         dropout: float,
         attn_dropout: float,
+        norm_first: bool = False,
+        activation: str = "relu",
+        compile_layers: bool = False,
     ):
         super().__init__()
 
@@ -70,15 +98,29 @@ class TransformerEncoder(nn.Module):
                     d_v,
                     d_ffn,
                     dropout,
+                    norm_first,
+                    activation,
                 )
                 for _ in range(n_layers)
             ]
         )
+        # Pre-LN layers leave their output un-normalized, hence a final layer-norm is needed for the stack.
+        # it only exists with Pre-LN to keep the state dict of Post-LN models unchanged
+        self.layer_norm = nn.LayerNorm(d_model, eps=1e-6) if norm_first else None
+
+        if compile_layers:
+            assert hasattr(
+                nn.Module, "compile"
+            ), "compile_layers requires torch>=2.2, please upgrade your PyTorch"
+            # compile in place to keep the keys of the state dict unchanged
+            for layer in self.enc_layer_stack:
+                layer.compile(dynamic=False, mode="max-autotune")
 
     def forward(
         self,
         x: torch.Tensor,
         src_mask: Optional[torch.Tensor] = None,
+        return_attn_weights: bool = False,
     ) -> Union[torch.Tensor, Tuple[torch.Tensor, list]]:
         """Forward processing of the encoder.
 
@@ -90,6 +132,9 @@ class TransformerEncoder(nn.Module):
         src_mask:
             Masking tensor for the attention map. The shape should be [batch_size, n_heads, n_steps, n_steps].
 
+        return_attn_weights:
+            Whether to compute the attention map in each encoder layer.
+
         Returns
         -------
         enc_output:
@@ -97,15 +142,24 @@ class TransformerEncoder(nn.Module):
 
         attn_weights_collector:
             A list containing the attention map from each encoder layer.
+            The attention maps are None if return_attn_weights is False.
 
         """
         attn_weights_collector = []
         enc_output = x
+        src_mask = _prepare_attn_mask(src_mask)
 
         for layer in self.enc_layer_stack:
-            enc_output, attn_weights = layer(enc_output, src_mask)
+            enc_output, attn_weights = layer(
+                enc_output,
+                src_mask,
+                return_attn_weights=return_attn_weights,
+            )
             attn_weights_collector.append(attn_weights)
 
+        if self.layer_norm is not None:
+            enc_output = self.layer_norm(enc_output)
+
         return enc_output, attn_weights_collector
 
 
@@ -145,6 +199,13 @@ class TransformerDecoder(nn.Module):
     attn_dropout:
         The dropout rate for the attention map.
 
+    activation:
+        The activation function of the feed-forward networks, "relu" or "gelu".
+
+    compile_layers:
+        Whether to compile each decoder layer with torch.compile (torch>=2.2) to fuse its operations into
+        fewer kernels. The compilation happens lazily in the first forward pass.
+
     """
 
     def __init__(
@@ -159,6 +220,8 @@ class TransformerDecoder(nn.Module):
         d_ffn: int,
         dropout: float,
         attn_dropout: float,
+        activation: str = "relu",
+        compile_layers: bool = False,
     ):
         super().__init__()
         self.embedding = nn.Linear(n_features, d_model)
@@ -175,11 +238,20 @@ class TransformerDecoder(nn.Module):
                     d_v,
                     d_ffn,
                     dropout,
+                    activation=activation,
                 )
                 for _ in range(n_layers)
             ]
         )
 
+        if compile_layers:
+            assert hasattr(
+                nn.Module, "compile"
+            ), "compile_layers requires torch>=2.2, please upgrade your PyTorch"
+            # compile in place to keep the keys of the state dict unchanged
+            for layer in self.layer_stack:
+                layer.compile(dynamic=False, mode="max-autotune")
+
     def forward(
         self,
         trg_seq: torch.Tensor,
@@ -224,6 +296,8 @@ class TransformerDecoder(nn.Module):
 
         dec_slf_attn_collector = []
         dec_enc_attn_collector = []
+        trg_mask = _prepare_attn_mask(trg_mask)
+        src_mask = _prepare_attn_mask(src_mask)
 
         for layer in self.layer_stack:
             dec_output, dec_slf_attn, dec_enc_attn = layer(
@@ -231,6 +305,7 @@ class TransformerDecoder(nn.Module):
                 enc_output,
                 slf_attn_mask=trg_mask,
                 dec_enc_attn_mask=src_mask,
+                return_attn_weights=return_attn_weights,
             )
             dec_slf_attn_collector.append(dec_slf_attn)
             dec_enc_attn_collector.append(dec_enc_attn)
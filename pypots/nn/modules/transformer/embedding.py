@@ -16,6 +16,25 @@ import torch.fft
 import torch.nn as nn
 
 
+def _get_sinusoid_encoding_table(n_positions: int, d_hid: int) -> torch.Tensor:
+    """Build the sinusoid positional-encoding table of shape [1, n_positions, d_hid] with vectorized operations.
+    The table is always built as float32 on CPU, regardless of the default dtype and device.
+    """
+    factory_kwargs = {"dtype": torch.float32, "device": "cpu"}
+    position = torch.arange(0, n_positions, **factory_kwargs).unsqueeze(1)
+    # keep the float32 logarithm as before, to produce exactly the same table as the previous versions
+    div_term = (
+        torch.arange(0, d_hid, 2, **factory_kwargs)
+        * -(torch.log(torch.tensor(10000.0, **factory_kwargs)) / d_hid)
+    ).exp()
+    angles = position * div_term
+
+    pe = torch.zeros(n_positions, d_hid, **factory_kwargs)
+    pe[:, 0::2] = torch.sin(angles)
+    pe[:, 1::2] = torch.cos(angles)
+    return pe.unsqueeze(0)
+
+
 class PositionalEncoding(nn.Module):
     """The original positional-encoding module for Transformer.
 
@@ -31,18 +50,9 @@ class PositionalEncoding(nn.Module):
 
     def __init__(self, d_hid: int, n_positions: int = 1000):
         super().__init__()
-        pe = torch.zeros(n_positions, d_hid, requires_grad=False).float()
-        position = torch.arange(0, n_positions).float().unsqueeze(1)
-        div_term = (
-            torch.arange(0, d_hid, 2).float()
-            * -(torch.log(torch.tensor(10000)) / d_hid)
-        ).exp()
-
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-
-        pe = pe.unsqueeze(0)
-        self.register_buffer("pos_table", pe)
+        self.register_buffer(
+            "pos_table", _get_sinusoid_encoding_table(n_positions, d_hid)
+        )
 
     def forward(self, x: torch.Tensor, return_only_pos: bool = False) -> torch.Tensor:
         """Forward processing of the positional encoding module.
@@ -59,12 +69,15 @@ class PositionalEncoding(nn.Module):
         -------
         If return_only_pos is True:
             pos_enc:
-                The positional encoding.
+                The positional encoding. It is a view of the buffer pos_table, don't modify it in place.
         else:
             x_with_pos:
                 Output tensor, the input tensor with the positional encoding added.
         """
-        pos_enc = self.pos_table[:, : x.size(1)].clone().detach()
+        # pos_table is a buffer without gradient, slicing it gives a view that needs no copy.
+        # pos_table is kept in float32, cast it to the dtype of x (no-op if the same) to avoid type promotion
+        # when x is in half precision, e.g. under torch.autocast
+        pos_enc = self.pos_table[:, : x.size(1)].to(x.dtype)
 
         if return_only_pos:
             return pos_enc
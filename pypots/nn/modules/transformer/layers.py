@@ -28,10 +28,30 @@ class PositionWiseFeedForward(nn.Module):
     dropout:
         The dropout rate.
 
+    norm_first:
+        Whether to apply layer-norm before the sub-layer (Pre-LN) rather than after the residual connection (Post-LN).
+        Models trained with the previous versions of PyPOTS are Post-LN and require norm_first=False.
+
+    activation:
+        The activation function of the feed-forward network, "relu" or "gelu".
+
     """
 
-    def __init__(self, d_in: int, d_hid: int, dropout: float = 0.1):
+    def __init__(
+        self,
+        d_in: int,
+        d_hid: int,
+        dropout: float = 0.1,
+        norm_first: bool = False,
+        activation: str = "relu",
+    ):
         super().__init__()
+        assert activation in (
+            "relu",
+            "gelu",
+        ), f"activation should be 'relu' or 'gelu', but got {activation}"
+        self.norm_first = norm_first
+        self.activation = F.relu if activation == "relu" else F.gelu
         self.linear_1 = nn.Linear(d_in, d_hid)
         self.linear_2 = nn.Linear(d_hid, d_in)
         self.layer_norm = nn.LayerNorm(d_in, eps=1e-6)
@@ -52,16 +72,20 @@ class PositionWiseFeedForward(nn.Module):
         """
         # save the original input for the later residual connection
         residual = x
-        # the 1st linear processing and ReLU non-linear projection
-        x = F.relu(self.linear_1(x))
-        # the 2nd linear processing
-        x = self.linear_2(x)
+        if self.norm_first:
+            x = self.layer_norm(x)
+        # the 1st linear processing and non-linear activation, then the 2nd linear processing,
+        # written as one functional chain so that compilers (e.g. torch.compile) can fuse the bias-add
+        # and the element-wise activation with the 1st GEMM
+        x = self.linear_2(self.activation(self.linear_1(x)))
         # apply dropout
-        x = self.dropout(x)
-        # apply residual connection
-        x += residual
-        # apply layer-norm
-        x = self.layer_norm(x)
+        x = F.dropout(x, p=self.dropout.p, training=self.training)
+        if self.norm_first:
+            # apply residual connection
+            return residual + x
+        # apply residual connection and layer-norm, the addition is out-of-place
+        # so that it can be fused together with the layer-norm
+        x = self.layer_norm(residual + x)
         return x
 
 
@@ -91,6 +115,13 @@ class TransformerEncoderLayer(nn.Module):
     dropout:
         The dropout rate.
 
+    norm_first:
+        Whether to apply layer-norm before the sub-layer (Pre-LN) rather than after the residual connection (Post-LN).
+        Models trained with the previous versions of PyPOTS are Post-LN and require norm_first=False.
+
+    activation:
+        The activation function of the feed-forward network, "relu" or "gelu".
+
     """
 
     def __init__(
@@ -102,6 +133,8 @@ class TransformerEncoderLayer(nn.Module):
         d_v: int,
         d_ffn: int,
         dropout: float = 0.1,
+        norm_first: bool = False,
+        activation: str = "relu",
     ):
         super().__init__()
         self.slf_attn = MultiHeadAttention(
@@ -111,9 +144,12 @@ class TransformerEncoderLayer(nn.Module):
             d_k,
             d_v,
         )
+        self.norm_first = norm_first
         self.dropout = nn.Dropout(dropout)
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
-        self.pos_ffn = PositionWiseFeedForward(d_model, d_ffn, dropout)
+        self.pos_ffn = PositionWiseFeedForward(
+            d_model, d_ffn, dropout, norm_first, activation
+        )
 
     def forward(
         self,
@@ -140,20 +176,20 @@ class TransformerEncoderLayer(nn.Module):
             The attention map.
 
         """
+        attn_input = self.layer_norm(enc_input) if self.norm_first else enc_input
         enc_output, attn_weights = self.slf_attn(
-            enc_input,
-            enc_input,
-            enc_input,
+            attn_input,
+            attn_input,
+            attn_input,
             attn_mask=src_mask,
             **kwargs,
         )
 
-        # apply dropout and residual connection
-        enc_output = self.dropout(enc_output)
-        enc_output += enc_input
-
-        # apply layer-norm
-        enc_output = self.layer_norm(enc_output)
+        # apply dropout and residual connection, then layer-norm if it is not applied first
+        enc_output = F.dropout(enc_output, p=self.dropout.p, training=self.training)
+        enc_output = enc_input + enc_output
+        if not self.norm_first:
+            enc_output = self.layer_norm(enc_output)
 
         enc_output = self.pos_ffn(enc_output)
         return enc_output, attn_weights
@@ -188,6 +224,9 @@ class TransformerDecoderLayer(nn.Module):
     dropout:
         The dropout rate.
 
+    activation:
+        The activation function of the feed-forward network, "relu" or "gelu".
+
     """
 
     def __init__(
@@ -200,6 +239,7 @@ class TransformerDecoderLayer(nn.Module):
         d_v: int,
         d_ffn: int,
         dropout: float = 0.1,
+        activation: str = "relu",
     ):
         super().__init__()
         self.slf_attn = MultiHeadAttention(
@@ -216,7 +256,9 @@ class TransformerDecoderLayer(nn.Module):
             d_k,
             d_v,
         )
-        self.pos_ffn = PositionWiseFeedForward(d_model, d_ffn, dropout)
+        self.pos_ffn = PositionWiseFeedForward(
+            d_model, d_ffn, dropout, activation=activation
+        )
 
     def forward(
         self,
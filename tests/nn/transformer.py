@@ -0,0 +1,394 @@
+"""
+Test cases for the Transformer modules.
+"""
+
+# Created by Wenjie Du <wenjay.du@gmail.com>
+# License: BSD-3-Clause
+
+
+import unittest
+
+import pytest
+import torch
+import torch.nn as nn
+
+from pypots.nn.modules.saits import BackboneSAITS
+from pypots.nn.modules.transformer import (
+    ScaledDotProductAttention,
+    MultiHeadAttention,
+    PositionalEncoding,
+    TransformerEncoder,
+    TransformerDecoder,
+)
+from pypots.utils.logging import logger
+
+BATCH_SIZE = 4
+N_STEPS = 12
+N_FEATURES = 5
+N_LAYERS = 2
+D_MODEL = 32
+N_HEADS = 4
+D_K = 8
+D_V = 8
+D_FFN = 64
+
+
+def _reference_attention(q, k, v, temperature, attn_mask=None):
+    """The implementation of scaled dot-product attention before the SDPA dispatching,
+    taking q, k, v of shape [batch_size, n_steps, n_heads, d_tensor]."""
+    q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    attn = torch.matmul(q / temperature, k.transpose(2, 3))
+    if attn_mask is not None:
+        attn = attn.masked_fill(attn_mask == 0, -1e9)
+    attn = torch.softmax(attn, dim=-1)
+    return torch.matmul(attn, v), attn
+
+
+def _build_encoder(**kwargs):
+    return TransformerEncoder(
+        N_LAYERS, D_MODEL, N_HEADS, D_K, D_V, D_FFN, 0, 0, **kwargs
+    ).eval()
+
+
+def _build_decoder(**kwargs):
+    return TransformerDecoder(
+        N_STEPS, N_FEATURES, N_LAYERS, D_MODEL, N_HEADS, D_K, D_V, D_FFN, 0, 0, **kwargs
+    ).eval()
+
+
+class TestScaledDotProductAttention(unittest.TestCase):
+    logger.info("Running tests for the scaled dot-product attention...")
+
+    torch.manual_seed(0)
+    q = torch.randn(BATCH_SIZE, N_STEPS, N_HEADS, D_K)
+    k = torch.randn(BATCH_SIZE, N_STEPS, N_HEADS, D_K)
+    v = torch.randn(BATCH_SIZE, N_STEPS, N_HEADS, D_V)
+
+    # the keys of the last sample are partially padded
+    key_padding_mask = torch.ones(BATCH_SIZE, 1, 1, N_STEPS)
+    key_padding_mask[-1, ..., N_STEPS // 2 :] = 0
+    # all keys of the second sample are padded, its attention falls back to the uniform one over all keys
+    fully_masked = torch.ones(BATCH_SIZE, 1, N_STEPS, N_STEPS)
+    fully_masked[1] = 0
+    masks = {
+        "none": None,
+        "diagonal": (1 - torch.eye(N_STEPS)).expand(BATCH_SIZE, 1, N_STEPS, N_STEPS),
+        "per_head_bool": torch.rand(BATCH_SIZE, N_HEADS, N_STEPS, N_STEPS) > 0.3,
+        "key_padding": key_padding_mask,
+        "shared": (1 - torch.eye(N_STEPS)).expand(1, 1, N_STEPS, N_STEPS),
+        "fully_masked": fully_masked,
+        "fully_masked_bool": fully_masked.bool(),
+    }
+    # make sure no row of the random mask is fully masked out
+    masks["per_head_bool"][..., 0] = True
+
+    attention = ScaledDotProductAttention(D_K**0.5, attn_dropout=0).eval()
+
+    @pytest.mark.xdist_group(name="nn-transformer-sdpa")
+    def test_0_explicit_vs_reference(self):
+        for name, mask in self.masks.items():
+            output, attn = self.attention(
+                self.q, self.k, self.v, mask, return_attn_weights=True
+            )
+            ref_output, ref_attn = _reference_attention(
+                self.q, self.k, self.v, D_K**0.5, mask
+            )
+            assert torch.allclose(
+                output, ref_output, atol=1e-5
+            ), f"the output with the mask {name} differs from the reference"
+            assert torch.allclose(
+                attn, ref_attn, atol=1e-6
+            ), f"the attention map with the mask {name} differs from the reference"
+
+    @pytest.mark.xdist_group(name="nn-transformer-sdpa")
+    def test_1_sdpa_vs_explicit(self):
+        for name, mask in self.masks.items():
+            output, attn = self.attention(
+                self.q, self.k, self.v, mask, return_attn_weights=False
+            )
+            explicit_output, explicit_attn = self.attention(
+                self.q, self.k, self.v, mask, return_attn_weights=True
+            )
+            assert attn is None, "the attention map should not be returned"
+            assert explicit_attn is not None, "the attention map should be returned"
+            assert torch.allclose(
+                output, explicit_output, atol=1e-5
+            ), f"the outputs with the mask {name} differ between SDPA and the explicit path"
+
+    @pytest.mark.xdist_group(name="nn-transformer-sdpa")
+    def test_3_fully_masked_rows(self):
+        mask = self.masks["fully_masked"]
+        uniform_output = self.v[1].transpose(0, 1).mean(dim=1, keepdim=True)
+        for return_attn_weights in (False, True):
+            output, _ = self.attention(
+                self.q, self.k, self.v, mask, return_attn_weights=return_attn_weights
+            )
+            assert not torch.isnan(output).any()
+            assert torch.allclose(
+                output[1], uniform_output.expand_as(output[1]), atol=1e-5
+            ), "fully masked rows should attend uniformly to all positions"
+
+    @pytest.mark.xdist_group(name="nn-transformer-sdpa")
+    def test_2_multi_head_attention_3d_mask(self):
+        mha = MultiHeadAttention(self.attention, D_MODEL, N_HEADS, D_K, D_V).eval()
+        x = torch.randn(BATCH_SIZE, N_STEPS, D_MODEL)
+        mask_3d = 1 - torch.eye(N_STEPS).expand(BATCH_SIZE, N_STEPS, N_STEPS)
+        output, _ = mha(x, x, x, mask_3d)
+        output_4d, attn = mha(x, x, x, mask_3d.unsqueeze(1), return_attn_weights=True)
+        assert torch.allclose(output, output_4d, atol=1e-5)
+        assert torch.all(
+            attn.diagonal(dim1=-2, dim2=-1) == 0
+        ), "the masked positions should have zero attention"
+
+    @pytest.mark.xdist_group(name="nn-transformer-sdpa")
+    def test_4_float16(self):
+        q, k, v = self.q.half(), self.k.half(), self.v.half()
+        for name, mask in self.masks.items():
+            # the reference is computed in float32 from the same rounded inputs
+            ref_output, _ = _reference_attention(
+                q.float(), k.float(), v.float(), D_K**0.5, mask
+            )
+            for return_attn_weights in (False, True):
+                output, _ = self.attention(
+                    q, k, v, mask, return_attn_weights=return_attn_weights
+                )
+                assert output.dtype == torch.float16
+                # -1e9 would overflow to -inf in float16 and give NaN for the fully masked rows
+                assert not torch.isnan(output).any(), f"NaN with the mask {name}"
+                # the scores are not fully swamped by the bias in float16, skip the fully masked sample
+                samples = [0, 2, 3] if name.startswith("fully_masked") else slice(None)
+                assert torch.allclose(
+                    output[samples].float(), ref_output[samples], atol=1e-2
+                ), f"the float16 output with the mask {name} differs from the reference"
+
+    @pytest.mark.xdist_group(name="nn-transformer-sdpa")
+    def test_5_half_precision_softmax(self):
+        mask = self.masks["key_padding"]
+        for dtype in (torch.float16, torch.bfloat16):
+            q, k, v = self.q.to(dtype), self.k.to(dtype), self.v.to(dtype)
+            _, attn = self.attention(q, k, v, mask, return_attn_weights=True)
+            _, ref_attn = _reference_attention(
+                q.float(), k.float(), v.float(), D_K**0.5, mask
+            )
+            # softmax reduces in float32, only the final cast to the half-precision dtype is rounded
+            assert attn.dtype == dtype
+            assert torch.allclose(
+                attn.float(), ref_attn, atol=torch.finfo(dtype).eps
+            ), f"the {dtype} attention map differs from the float32 one"
+
+        # under autocast, the GEMMs run in bfloat16 while the attention map is still normalized
+        mha = MultiHeadAttention(self.attention, D_MODEL, N_HEADS, D_K, D_V).eval()
+        x = torch.randn(BATCH_SIZE, N_STEPS, D_MODEL)
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+            _, attn = mha(x, x, x, mask, return_attn_weights=True)
+        assert attn.dtype == torch.bfloat16
+        assert torch.allclose(
+            attn.float().sum(dim=-1),
+            torch.ones(BATCH_SIZE, N_HEADS, N_STEPS),
+            atol=1e-2,
+        )
+
+
+class TestStateDictCompatibility(unittest.TestCase):
+    logger.info("Running tests for loading the state dict of the previous versions...")
+
+    @staticmethod
+    def _to_baseline_format(state_dict: dict) -> dict:
+        """Convert a state dict to the format saved by the previous versions, i.e. with separate
+        projections w_qs/w_ks/w_vs."""
+        baseline_state_dict = {}
+        for key, value in state_dict.items():
+            if key.endswith("w_qkv.weight"):
+                prefix = key[: -len("w_qkv.weight")]
+                w_qs, w_ks, w_vs = value.split(
+                    [N_HEADS * D_K, N_HEADS * D_K, N_HEADS * D_V]
+                )
+                baseline_state_dict[f"{prefix}w_qs.weight"] = w_qs.clone()
+                baseline_state_dict[f"{prefix}w_ks.weight"] = w_ks.clone()
+                baseline_state_dict[f"{prefix}w_vs.weight"] = w_vs.clone()
+            else:
+                baseline_state_dict[key] = value.clone()
+        return baseline_state_dict
+
+    @pytest.mark.xdist_group(name="nn-transformer-state-dict")
+    def test_0_load_baseline_state_dict(self):
+        torch.manual_seed(0)
+        decoder = _build_decoder()
+        baseline_state_dict = self._to_baseline_format(decoder.state_dict())
+        assert not any(
+            key.endswith("w_qkv.weight") for key in baseline_state_dict
+        ), "the baseline state dict should only contain the separate projections"
+
+        new_decoder = _build_decoder()
+        # strict loading fails on any unexpected or missing key
+        new_decoder.load_state_dict(baseline_state_dict)
+        assert set(new_decoder.state_dict().keys()) == set(
+            decoder.state_dict().keys()
+        ), "w_qs/w_ks/w_vs should be fused into w_qkv"
+
+        trg_seq = torch.randn(BATCH_SIZE, N_STEPS, N_FEATURES)
+        enc_output = torch.randn(BATCH_SIZE, N_STEPS, D_MODEL)
+        with torch.no_grad():
+            assert torch.equal(
+                decoder(trg_seq, enc_output), new_decoder(trg_seq, enc_output)
+            ), "the loaded model should produce the same output"
+
+    @pytest.mark.xdist_group(name="nn-transformer-state-dict")
+    def test_1_pos_table(self):
+        position_enc = PositionalEncoding(D_MODEL, n_positions=N_STEPS)
+        # pos_table is still saved in the state dict, as the previous versions expect it in strict loading
+        assert "pos_table" in position_enc.state_dict()
+        assert position_enc.pos_table.dtype == torch.float32
+        assert (
+            position_enc.pos_table
+            is not PositionalEncoding(D_MODEL, n_positions=N_STEPS).pos_table
+        ), "separate instances must not alias the same table"
+
+    @pytest.mark.xdist_group(name="nn-transformer-state-dict")
+    def test_2_saits_shared_pos_table(self):
+        backbone = BackboneSAITS(
+            N_STEPS, N_FEATURES, N_LAYERS, D_MODEL, N_HEADS, D_K, D_V, D_FFN, 0, 0
+        )
+        assert backbone.embedding_1.position_enc is backbone.embedding_2.position_enc
+        # moving the model converts each buffer separately, only a shared module keeps a single table
+        backbone.double()
+        assert (
+            backbone.embedding_1.position_enc.pos_table.data_ptr()
+            == backbone.embedding_2.position_enc.pos_table.data_ptr()
+        )
+
+        # both embedding blocks still save the table, so the state dict keeps the same keys as before
+        state_dict = backbone.state_dict()
+        assert "embedding_1.position_enc.pos_table" in state_dict
+        assert "embedding_2.position_enc.pos_table" in state_dict
+        BackboneSAITS(
+            N_STEPS, N_FEATURES, N_LAYERS, D_MODEL, N_HEADS, D_K, D_V, D_FFN, 0, 0
+        ).double().load_state_dict(state_dict)
+
+
+class TestTransformerEncoderOptions(unittest.TestCase):
+    logger.info("Running tests for the options of the Transformer encoder...")
+
+    x = torch.randn(BATCH_SIZE, N_STEPS, D_MODEL)
+    mask = (1 - torch.eye(N_STEPS)).expand(BATCH_SIZE, N_STEPS, N_STEPS)
+
+    @pytest.mark.xdist_group(name="nn-transformer-options")
+    def test_0_norm_first(self):
+        encoder = _build_encoder(norm_first=True)
+        assert "layer_norm.weight" in encoder.state_dict(), "Pre-LN needs a final norm"
+        assert (
+            "layer_norm.weight" not in _build_encoder().state_dict()
+        ), "the state dict of Post-LN models should stay unchanged"
+
+        with torch.no_grad():
+            enc_output, attn_weights_collector = encoder(
+                self.x, self.mask, return_attn_weights=True
+            )
+        assert enc_output.shape == self.x.shape
+        assert len(attn_weights_collector) == N_LAYERS
+        assert not torch.isnan(enc_output).any()
+
+    @pytest.mark.xdist_group(name="nn-transformer-options")
+    def test_1_activation(self):
+        torch.manual_seed(0)
+        relu_encoder = _build_encoder(activation="relu")
+        gelu_encoder = _build_encoder(activation="gelu")
+        gelu_encoder.load_state_dict(relu_encoder.state_dict())
+        with torch.no_grad():
+            relu_output, _ = relu_encoder(self.x, self.mask)
+            gelu_output, _ = gelu_encoder(self.x, self.mask)
+        assert relu_output.shape == gelu_output.shape == self.x.shape
+        assert not torch.allclose(
+            relu_output, gelu_output
+        ), "the activation function should take effect"
+
+    @pytest.mark.xdist_group(name="nn-transformer-options")
+    @pytest.mark.skipif(
+        not hasattr(nn.Module, "compile"),
+        reason="nn.Module.compile requires torch>=2.2",
+    )
+    def test_2_compile_layers(self):
+        torch.manual_seed(0)
+        eager_encoder = _build_encoder()
+        compiled_encoder = _build_encoder(compile_layers=True)
+        # compiling in place keeps the keys of the state dict unchanged
+        compiled_encoder.load_state_dict(eager_encoder.state_dict())
+        with torch.no_grad():
+            eager_output, _ = eager_encoder(self.x, self.mask)
+            compiled_output, _ = compiled_encoder(self.x, self.mask)
+        assert torch.allclose(eager_output, compiled_output, atol=1e-5)
+
+
+class TestTransformerDecoderOptions(unittest.TestCase):
+    logger.info("Running tests for the options of the Transformer decoder...")
+
+    trg_seq = torch.randn(BATCH_SIZE, N_STEPS, N_FEATURES)
+    enc_output = torch.randn(BATCH_SIZE, N_STEPS, D_MODEL)
+    mask = (1 - torch.eye(N_STEPS)).expand(BATCH_SIZE, N_STEPS, N_STEPS)
+
+    @pytest.mark.xdist_group(name="nn-transformer-decoder-options")
+    @pytest.mark.skipif(
+        not hasattr(nn.Module, "compile"),
+        reason="nn.Module.compile requires torch>=2.2",
+    )
+    def test_0_compile_layers(self):
+        torch.manual_seed(0)
+        eager_decoder = _build_decoder()
+        compiled_decoder = _build_decoder(compile_layers=True)
+        compiled_decoder.load_state_dict(eager_decoder.state_dict())
+        with torch.no_grad():
+            eager_output, eager_slf_attn, eager_enc_attn = eager_decoder(
+                self.trg_seq,
+                self.enc_output,
+                self.mask,
+                self.mask,
+                return_attn_weights=True,
+            )
+            compiled_output, compiled_slf_attn, compiled_enc_attn = compiled_decoder(
+                self.trg_seq,
+                self.enc_output,
+                self.mask,
+                self.mask,
+                return_attn_weights=True,
+            )
+        assert torch.allclose(eager_output, compiled_output, atol=1e-5)
+        for eager_attn, compiled_attn in zip(
+            eager_slf_attn + eager_enc_attn, compiled_slf_attn + compiled_enc_attn
+        ):
+            assert torch.allclose(eager_attn, compiled_attn, atol=1e-5)
+
+
+class TestMixedPrecision(unittest.TestCase):
+    logger.info("Running tests for the Transformer modules in half precision...")
+
+    x = torch.randn(BATCH_SIZE, N_STEPS, D_MODEL)
+    trg_seq = torch.randn(BATCH_SIZE, N_STEPS, N_FEATURES)
+    mask = (1 - torch.eye(N_STEPS)).expand(BATCH_SIZE, N_STEPS, N_STEPS)
+
+    @pytest.mark.xdist_group(name="nn-transformer-half")
+    def test_0_autocast_bfloat16(self):
+        torch.manual_seed(0)
+        encoder, decoder = _build_encoder(), _build_decoder()
+        with torch.no_grad():
+            enc_output, _ = encoder(self.x, self.mask)
+            dec_output = decoder(self.trg_seq, enc_output, self.mask)
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                # the float32 positional table is cast to bfloat16 rather than promoting the embedding to float32
+                pos_output = decoder.position_enc(self.x.bfloat16())
+                bf16_enc_output, _ = encoder(self.x, self.mask)
+                bf16_dec_output = decoder(self.trg_seq, bf16_enc_output, self.mask)
+
+        assert pos_output.dtype == torch.bfloat16
+        assert decoder.position_enc.pos_table.dtype == torch.float32
+        for output, bf16_output in (
+            (enc_output, bf16_enc_output),
+            (dec_output, bf16_dec_output),
+        ):
+            assert not torch.isnan(bf16_output).any()
+            assert torch.allclose(
+                output, bf16_output.float(), atol=0.1
+            ), "the output in bfloat16 autocast deviates too much from the one in float32"
+
+
+if __name__ == "__main__":
+    unittest.main()